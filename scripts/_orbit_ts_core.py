@@ -0,0 +1,415 @@
+#!/usr/bin/env python3
+"""
+orbit-engine 時間序列共用核心
+
+convert_orbit_engine_to_timeseries.py、generate_from_orbit_engine.py、
+generate_satellite_timeseries.py 與 integrate_stage5_signal_data.py 共用：
+- Stage 4 輸出定位、TLE 文件讀取與磁碟快取
+- 時間戳解析、時間軸索引構建（衛星 × 時間矩陣）與覆蓋率驗證
+- 可見區段輸出與串流 JSON / MessagePack 寫出
+- 生成腳本的共用時間陣列、子進程狀態與進度輸出
+"""
+
+import hashlib
+import pickle
+from contextlib import contextmanager
+import numpy as np
+import orjson
+from pathlib import Path
+
+# 文件路徑
+ORBIT_ENGINE_STAGE4_DIR = Path("/home/sat/satellite/orbit-engine/data/outputs/stage4")
+CACHE_DIR = Path.home() / ".cache/leo-sim"
+
+# 輸出量化：可見區段的數值以整數輸出，實際值 = 整數 × metadata.scale[欄位]
+QUANTIZATION = {
+    'elevation_deg': (100, np.int16),   # 0.01°
+    'azimuth_deg': (100, np.uint16),    # 0.01°（0–360° → 0–36000）
+    'range_km': (10, np.uint16)         # 0.1 km（上限 6553.5 km）
+}
+VALUE_SCALE = {field: 1 / factor for field, (factor, _) in QUANTIZATION.items()}
+
+# 生成腳本的進度訊息每累積幾行合併輸出一次
+PROGRESS_PRINT_EVERY = 50
+
+# ==================== 輸入與快取 ====================
+
+def find_latest_orbit_engine_output():
+    """自動找到 stage4 目錄中最新的輸出文件"""
+    json_files = list(ORBIT_ENGINE_STAGE4_DIR.glob("link_feasibility_output_*.json"))
+
+    if not json_files:
+        raise FileNotFoundError(f"在 {ORBIT_ENGINE_STAGE4_DIR} 中找不到 orbit-engine 輸出文件")
+
+    # 按修改時間排序，取最新的
+    latest_file = max(json_files, key=lambda p: p.stat().st_mtime)
+    print(f"📂 自動選擇最新的 orbit-engine 輸出: {latest_file.name}")
+    return latest_file
+
+def iter_tle_records(tle_file: Path):
+    """
+    逐組產生 TLE 記錄 (名稱, 第1行, 第2行)
+
+    逐行串流讀取並跳過空行，不保留整份文件；每3行一組，不完整的尾組自動捨棄
+    """
+    with open(tle_file, 'r') as f:
+        lines = (stripped for stripped in map(str.strip, f) if stripped)
+        yield from zip(lines, lines, lines)
+
+def cache_file_for(key: str) -> Path:
+    """以快取鍵（通常包含輸入路徑、修改時間與大小）計算快取文件路徑"""
+    return CACHE_DIR / f"{hashlib.blake2b(key.encode(), digest_size=16).hexdigest()}.pkl"
+
+def write_cache(cache_file: Path, obj):
+    """寫入 pickle 快取：先寫入暫存文件再替換，避免中斷時留下不完整的快取"""
+    cache_file.parent.mkdir(parents=True, exist_ok=True)
+    tmp_file = cache_file.with_suffix('.tmp')
+    with open(tmp_file, 'wb') as f:
+        pickle.dump(obj, f, protocol=5)
+    tmp_file.replace(cache_file)
+
+# ==================== 時間軸索引 ====================
+
+def parse_timestamps(timestamps):
+    """將 ISO-8601 UTC 時間戳字串批次轉為 datetime64[ns]（去除 +00:00 / Z 後綴）"""
+    return np.array(
+        [timestamp.removesuffix('+00:00').removesuffix('Z') for timestamp in timestamps],
+        dtype='datetime64[ns]'
+    )
+
+def format_timestamps(time_points):
+    """將 datetime64 時間軸轉回 ISO-8601 UTC 字串（與 orbit-engine 相同的 +00:00 格式）"""
+    return [f"{timestamp}+00:00" for timestamp in np.datetime_as_string(time_points, unit='s')]
+
+def build_time_index(satellite_pool):
+    """
+    從按衛星組織的數據構建完整時間軸索引
+
+    satellite_pool 可以是任意可迭代物件（例如串流讀取的生成器），只遍歷一次。
+
+    返回：
+    - time_points: 有序的時間軸（np.ndarray[datetime64[ns]]）
+    - satellites: 衛星基本資料列表 [{'satellite_id', 'name'}]，順序即矩陣的列順序
+    - visibility_matrices: {欄位: np.ndarray[S, T]}（第 s 列對應 satellites[s]）
+    """
+    print("\n🔨 構建時間軸索引...")
+
+    # 單次遍歷：所有衛星的數據點攤平成一維欄位，並記錄每顆衛星的點數；
+    # 時間戳字串在同一遍歷中去重（labels: 字串 → 首次出現序號），之後只需解析獨立時間點
+    satellites = []
+    point_counts = []
+    labels = {}
+    label_idx = []
+    elevation = []
+    azimuth = []
+    distance = []
+
+    for satellite in satellite_pool:
+        time_series = satellite['time_series']
+        for point in time_series:
+            metrics = point['visibility_metrics']
+            label_idx.append(labels.setdefault(point['timestamp'], len(labels)))
+            elevation.append(metrics['elevation_deg'])
+            azimuth.append(metrics['azimuth_deg'])
+            distance.append(metrics['distance_km'])
+
+        satellites.append({
+            'satellite_id': satellite['satellite_id'],
+            'name': satellite['name']
+        })
+        point_counts.append(len(time_series))
+
+    print(f"   ✓ 讀取 {len(satellites)} 顆衛星")
+
+    # 解析並排序獨立時間點（不同寫法的同一時刻會在此合併）；再映射回每個數據點的時間索引
+    time_points, label_to_time = np.unique(parse_timestamps(labels), return_inverse=True)
+    time_idx = label_to_time[np.asarray(label_idx, dtype=np.intp)]
+    sat_idx = np.repeat(np.arange(len(satellites)), point_counts)
+    print(f"   ✓ 找到 {len(time_points)} 個獨立時間點")
+
+    # 直接寫入預先配置的 (S×T) 矩陣：不可見時段保留默認值（地平線以下、遠距離）；
+    # 出現在衛星 Stage 4 time_series 中的時間點即視為可見（與 is_connectable 無關）
+    shape = (len(satellites), len(time_points))
+    visibility_matrices = {
+        'elevation_deg': np.full(shape, -90.0, dtype=np.float32),
+        'azimuth_deg': np.zeros(shape, dtype=np.float32),
+        'distance_km': np.full(shape, 9999.0, dtype=np.float32),
+        'is_visible': np.zeros(shape, dtype=np.bool_)
+    }
+    visibility_matrices['elevation_deg'][sat_idx, time_idx] = elevation
+    visibility_matrices['azimuth_deg'][sat_idx, time_idx] = azimuth
+    visibility_matrices['distance_km'][sat_idx, time_idx] = distance
+    visibility_matrices['is_visible'][sat_idx, time_idx] = True
+
+    return time_points, satellites, visibility_matrices
+
+def verify_coverage(satellite_pool, visibility_matrices):
+    """驗證覆蓋率是否符合 10-15 顆目標"""
+    print("\n📊 驗證覆蓋率...")
+
+    if not satellite_pool:
+        print("   ❌ 無衛星數據")
+        return
+
+    # 可見性矩陣 (S×T)，沿衛星軸加總即為每個時間點的可見數量
+    visibility_matrix = visibility_matrices['is_visible']
+    visible_counts = visibility_matrix.sum(axis=0)
+    total_time_points = visibility_matrix.shape[1]
+
+    avg_visible = float(visible_counts.mean())
+    min_visible = int(visible_counts.min())
+    max_visible = int(visible_counts.max())
+
+    # 計算滿足 10-15 顆目標的時間點比例
+    target_met = int(np.count_nonzero((visible_counts >= 10) & (visible_counts <= 15)))
+    target_met_rate = target_met / total_time_points
+
+    print(f"   平均可見: {avg_visible:.1f} 顆")
+    print(f"   範圍: {min_visible}-{max_visible} 顆")
+    print(f"   目標達成率: {target_met_rate*100:.1f}% ({target_met}/{total_time_points} 時間點)")
+
+    if 10 <= avg_visible <= 15 and target_met_rate >= 0.95:
+        print("   ✅ 符合目標（10-15 顆，95%+ 覆蓋率）")
+    else:
+        print("   ⚠️  未完全達標")
+
+    return {
+        'avg_visible': avg_visible,
+        'min_visible': min_visible,
+        'max_visible': max_visible,
+        'target_met_rate': target_met_rate
+    }
+
+# ==================== 輸出 ====================
+
+def compute_time_step(time_points):
+    """計算時間步長（秒）"""
+    if len(time_points) >= 2:
+        return int((time_points[1] - time_points[0]) // np.timedelta64(1, 's'))
+    return 30
+
+def find_visible_intervals(is_visible):
+    """找出布林序列中連續為 True 的區段，返回 (起始索引陣列, 結束索引陣列)（含結束點）"""
+    edges = np.diff(is_visible.astype(np.int8), prepend=0, append=0)
+    starts = np.flatnonzero(edges == 1)
+    ends = np.flatnonzero(edges == -1) - 1
+    return starts, ends
+
+def quantize(values, field):
+    """依 QUANTIZATION 將數值矩陣四捨五入為整數（超出型別範圍者截斷）"""
+    factor, dtype = QUANTIZATION[field]
+    info = np.iinfo(dtype)
+    return np.clip(np.round(values.astype(np.float64) * factor), info.min, info.max).astype(dtype)
+
+def generate_full_orbit_timeseries(starlink_pool, time_points, visibility_matrices, time_step_seconds):
+    """
+    逐顆產生每顆衛星的完整軌道週期數據（生成器，供串流寫出）
+
+    完整週期 = 可見時段 + 不可見時段，但只輸出可見區段（visible_intervals）：
+    - 每個區段記錄 start_idx/end_idx（時間軸索引，含結束點）與該區段的仰角、方位角、距離
+    - 不可見時段不再逐點填充，由前端以默認值（仰角 -90°、距離 9999 km）補回
+    - 區段數值為量化後的整數（見 QUANTIZATION），前端載入時乘上 metadata.scale 還原
+    - 絕對時間為 time_axis[idx]，時間偏移為 idx * time_step_seconds
+    """
+    print("\n🛰️  生成完整軌道週期數據...")
+    print(f"   時間步長: {time_step_seconds} 秒")
+    print(f"   軌道週期: {len(time_points)} 個時間點 ({len(time_points) * time_step_seconds / 60:.1f} 分鐘)")
+
+    # 所有衛星一次處理：(S×T) 矩陣上完成統計與量化
+    is_visible = visibility_matrices['is_visible']
+    elevation_in = visibility_matrices['elevation_deg']
+
+    visible_counts = is_visible.sum(axis=1).tolist()
+    max_elevations = np.where(is_visible, elevation_in, 0.0).max(axis=1, initial=0.0).tolist()
+
+    elevation = quantize(elevation_in, 'elevation_deg')
+    azimuth = quantize(visibility_matrices['azimuth_deg'], 'azimuth_deg')
+    range_km = quantize(visibility_matrices['distance_km'], 'range_km')
+
+    # 為每顆衛星生成可見區段（逐列轉為 Python 物件，避免一次展開整個矩陣）
+    for sat_idx, satellite in enumerate(starlink_pool, 1):
+        row = sat_idx - 1
+        sat_id = satellite['satellite_id']
+        visible_count = visible_counts[row]
+        max_elevation = max_elevations[row]
+
+        starts, ends = find_visible_intervals(is_visible[row])
+        visible_intervals = [
+            {
+                'start_idx': start,
+                'end_idx': end,
+                'elevation_deg': elevation[row, start:end + 1].tolist(),
+                'azimuth_deg': azimuth[row, start:end + 1].tolist(),
+                'range_km': range_km[row, start:end + 1].tolist()
+            }
+            for start, end in zip(starts.tolist(), ends.tolist())
+        ]
+
+        # 計算可見百分比
+        visible_percentage = (visible_count / len(time_points) * 100) if len(time_points) > 0 else 0
+
+        yield {
+            'id': sat_id,
+            'name': satellite['name'],
+            'constellation': 'starlink',
+            'config': {
+                'min_elevation_deg': 5.0,
+                'time_step_seconds': time_step_seconds,
+                'time_points': len(time_points)
+            },
+            'statistics': {
+                'visible_points': visible_count,
+                'visible_percentage': round(visible_percentage, 2),
+                'max_elevation': round(max_elevation, 2)
+            },
+            'visible_intervals': visible_intervals
+        }
+
+        if sat_idx % 10 == 0:
+            print(f"   [{sat_idx}/{len(starlink_pool)}] 處理中...")
+
+    print(f"   ✓ 完成 {len(starlink_pool)} 顆衛星")
+
+@contextmanager
+def atomic_output(output_file: Path):
+    """
+    以暫存文件寫出，成功完成後才替換目標文件
+
+    寫出過程中發生例外或中斷時刪除暫存文件並保留原本的輸出，避免前端讀到不完整的 JSON。
+    暫存文件名為「原檔名.tmp」，同名的 .json 與 .msgpack 不會互相覆蓋。
+    """
+    tmp_file = output_file.with_name(output_file.name + '.tmp')
+    try:
+        with open(tmp_file, 'wb') as f:
+            yield f
+    except BaseException:
+        tmp_file.unlink(missing_ok=True)
+        raise
+    tmp_file.replace(output_file)
+
+def write_timeseries_json(output_file: Path, header: dict, satellites, footer=None):
+    """
+    逐顆衛星串流寫出 JSON，峰值記憶體只需容納一顆衛星
+
+    輸出結構：{**header, "satellites": [...], **footer()}；每顆衛星佔一行。
+    footer 為無參數函數，在所有衛星寫完後才呼叫（用於依賴逐顆累計結果的統計）。
+    全部寫完後才替換 output_file（見 atomic_output）。
+    """
+    with atomic_output(output_file) as f:
+        f.write(orjson.dumps(header, option=orjson.OPT_SERIALIZE_NUMPY)[:-1])
+        f.write(b',"satellites":[\n')
+
+        for idx, satellite in enumerate(satellites):
+            if idx:
+                f.write(b',\n')
+            f.write(orjson.dumps(satellite, option=orjson.OPT_SERIALIZE_NUMPY))
+
+        tail = orjson.dumps(footer() if footer else {}, option=orjson.OPT_SERIALIZE_NUMPY)
+        f.write(b'\n]' + (b',' + tail[1:] if tail != b'{}' else b'}'))
+
+def _msgpack_default(obj):
+    """MessagePack 不支援的 numpy 型別轉為 Python 內建型別"""
+    if isinstance(obj, (np.ndarray, np.generic)):
+        return obj.tolist()
+    raise TypeError(f"無法序列化型別 {type(obj).__name__}")
+
+def _msgpack_packer():
+    """建立 MessagePack 編碼器（msgpack 僅輸出 msgpack 格式時需要）"""
+    import msgpack
+
+    return msgpack.Packer(default=_msgpack_default, use_bin_type=True)
+
+def write_timeseries_msgpack(output_file: Path, header: dict, satellites, footer=None):
+    """
+    以 MessagePack 寫出與 write_timeseries_json 相同結構的數據（二進位，體積與解析成本較低）
+
+    MessagePack 的陣列需先寫出長度，因此每顆衛星先各自編碼為位元組，全部編碼完成後再組合寫出；
+    峰值記憶體為編碼後的位元組，而非完整的 Python 物件。全部寫完後才替換 output_file。
+    """
+    packer = _msgpack_packer()
+    packed_satellites = [packer.pack(satellite) for satellite in satellites]
+    _write_packed_msgpack(output_file, packer, header, packed_satellites, footer)
+
+def write_timeseries_json_and_msgpack(json_file: Path, msgpack_file: Path, header: dict, satellites, footer=None):
+    """
+    同一次遍歷寫出 JSON 與 MessagePack 兩種格式（衛星數據只生成一次）
+
+    JSON 逐顆串流寫出的同時將每顆衛星編碼為 MessagePack，JSON 完成後再組合寫出 msgpack 文件
+    """
+    packer = _msgpack_packer()
+    packed_satellites = []
+
+    def pack_while_writing(satellites):
+        for satellite in satellites:
+            packed_satellites.append(packer.pack(satellite))
+            yield satellite
+
+    write_timeseries_json(json_file, header, pack_while_writing(satellites), footer)
+    _write_packed_msgpack(msgpack_file, packer, header, packed_satellites, footer)
+
+def _write_packed_msgpack(output_file: Path, packer, header: dict, packed_satellites, footer):
+    """組合檔頭、已編碼的衛星數據與檔尾，寫出 MessagePack 文件"""
+    tail = footer() if footer else {}
+
+    with atomic_output(output_file) as f:
+        f.write(packer.pack_map_header(len(header) + 1 + len(tail)))
+        for key, value in header.items():
+            f.write(packer.pack(key) + packer.pack(value))
+
+        f.write(packer.pack('satellites') + packer.pack_array_header(len(packed_satellites)))
+        f.writelines(packed_satellites)
+
+        for key, value in tail.items():
+            f.write(packer.pack(key) + packer.pack(value))
+
+# ==================== 衛星傳播（生成腳本共用） ====================
+
+def build_time_array(ts, start_time, time_points: int, time_step_seconds: int):
+    """建立整個計算時段的 Time 陣列（所有衛星共用，章動/歲差矩陣只計算一次）"""
+    from skyfield.nutationlib import iau2000b_radians  # 僅生成腳本需要 Skyfield
+
+    offsets = np.arange(time_points) * time_step_seconds
+    times = ts.ut1_jd(start_time.ut1 + offsets / 86400.0)
+
+    # 章動改用截斷的 IAU2000B 級數（77 項，取代 IAU2000A 的 1365 項），
+    # 誤差約 1 毫角秒，在衛星距離上不到 1 公尺，遠小於 TLE 本身約 1 km 的精度
+    times._nutation_angles_radians = iau2000b_radians(times)
+    return times
+
+# 子進程內的 Skyfield 物件（無法跨進程傳遞，由 init_worker 在每個子進程重建一次）
+worker_state = {}
+
+def init_worker(setup, *args):
+    """
+    ProcessPoolExecutor 的 initializer：在子進程內呼叫 setup(*args)，返回的字典存入 worker_state
+
+    setup 為各腳本的模組層級函數，負責重建時間尺度、時間陣列與座標轉換；工作函數再從 worker_state 讀取
+    """
+    worker_state.update(setup(*args))
+
+def report_progress(results, total, counters, describe):
+    """
+    逐顆記錄計算進度並轉交結果，同時累計統計（供串流寫出時使用）
+
+    describe(sat_data) 返回進度訊息中的衛星描述；訊息每 PROGRESS_PRINT_EVERY 行合併為一次輸出，
+    結束時輸出剩餘部分
+    """
+    lines = []
+    for sat_data in results:
+        counters['processed'] += 1
+
+        if sat_data['statistics']['visible_points'] > 0:
+            counters['visible'] += 1
+            status = f"✓ ({sat_data['statistics']['visible_percentage']:.1f}% 可見)"
+        else:
+            status = "⚠️  (不可見)"
+        lines.append(f"   [{counters['processed']}/{total}] {describe(sat_data)}... {status}")
+
+        if len(lines) >= PROGRESS_PRINT_EVERY:
+            print('\n'.join(lines))
+            lines.clear()
+
+        yield sat_data
+
+    if lines:
+        print('\n'.join(lines))
@@ -11,213 +11,110 @@
 - oneweb: 26顆，目標 3-6 顆可見
 """
 
-import json
 import argparse
-from datetime import datetime, timedelta
+import functools
+import pickle
+import ijson
+from datetime import datetime
 from pathlib import Path
-from collections import defaultdict
+
+from _orbit_ts_core import (
+    VALUE_SCALE,
+    build_time_index,
+    cache_file_for,
+    compute_time_step,
+    find_latest_orbit_engine_output,
+    format_timestamps,
+    generate_full_orbit_timeseries,
+    verify_coverage,
+    write_cache,
+    write_timeseries_json,
+    write_timeseries_json_and_msgpack,
+    write_timeseries_msgpack,
+)
 
 # 文件路徑
 PROJECT_ROOT = Path(__file__).parent.parent
-ORBIT_ENGINE_STAGE4_DIR = Path("/home/sat/satellite/orbit-engine/data/outputs/stage4")
-
-def find_latest_orbit_engine_output():
-    """自動找到 stage4 目錄中最新的輸出文件"""
-    json_files = list(ORBIT_ENGINE_STAGE4_DIR.glob("link_feasibility_output_*.json"))
-
-    if not json_files:
-        raise FileNotFoundError(f"在 {ORBIT_ENGINE_STAGE4_DIR} 中找不到 orbit-engine 輸出文件")
+CACHE_VERSION = 4  # 快取內容格式變更時遞增，使舊快取失效
 
-    # 按修改時間排序，取最新的
-    latest_file = max(json_files, key=lambda p: p.stat().st_mtime)
-    print(f"📂 自動選擇最新的 orbit-engine 輸出: {latest_file.name}")
-    return latest_file
+def iter_satellite_pool(orbit_engine_file: Path, constellation: str):
+    """逐顆串流讀取指定星座的候選池衛星（不需載入整份 JSON）"""
+    with open(orbit_engine_file, 'rb') as f:
+        yield from ijson.items(
+            f, f'pool_optimization.optimized_pools.{constellation}.item', use_float=True
+        )
 
-def load_orbit_engine_data(constellation='starlink'):
+def load_orbit_engine_data(orbit_engine_file: Path, constellation='starlink'):
     """載入 orbit-engine Stage 4 輸出
 
     Args:
+        orbit_engine_file: Stage 4 輸出文件
         constellation: 'starlink' 或 'oneweb'
+
+    Returns:
+        (衛星池迭代器, 覆蓋統計, 星座名稱)；衛星池以串流方式逐顆產生
     """
     print(f"📂 載入 orbit-engine Stage 4 輸出（星座: {constellation.upper()}）...")
-    orbit_engine_file = find_latest_orbit_engine_output()
-    with open(orbit_engine_file, 'r') as f:
-        data = json.load(f)
 
-    # 提取指定星座優化池
-    satellite_pool = data['pool_optimization']['optimized_pools'][constellation]
-    print(f"   ✓ {constellation.upper()} 候選池: {len(satellite_pool)} 顆衛星")
+    # 提取統計信息（只解析這個子樹）
+    with open(orbit_engine_file, 'rb') as f:
+        stats = next(ijson.items(
+            f,
+            f'pool_optimization.optimization_metrics.{constellation}.coverage_statistics',
+            use_float=True
+        ), None)
+
+    if stats is None:
+        raise KeyError(f"orbit-engine 輸出中找不到 {constellation} 的 coverage_statistics")
 
-    # 提取統計信息
-    stats = data['pool_optimization']['optimization_metrics'][constellation]['coverage_statistics']
     print(f"   ✓ 時間點數: {stats['total_time_points']}")
     print(f"   ✓ 平均可見: {stats['avg_visible']:.1f} 顆")
     print(f"   ✓ 範圍: {stats['min_visible']}-{stats['max_visible']} 顆")
 
-    return satellite_pool, stats, constellation
-
-def build_time_index(satellite_pool):
-    """
-    從按衛星組織的數據構建完整時間軸索引
+    # 提取指定星座優化池（串流）
+    satellite_pool = iter_satellite_pool(orbit_engine_file, constellation)
 
-    返回：
-    - time_points: 有序的時間點列表
-    - visibility_index: {timestamp: {sat_id: visibility_data}}
-    """
-    print("\n🔨 構建時間軸索引...")
-
-    # 收集所有時間戳
-    all_timestamps = set()
-    for satellite in satellite_pool:
-        for point in satellite['time_series']:
-            all_timestamps.add(point['timestamp'])
-
-    # 排序時間點
-    time_points = sorted(all_timestamps)
-    print(f"   ✓ 找到 {len(time_points)} 個獨立時間點")
-
-    # 構建可見性索引: {timestamp: {sat_id: data}}
-    visibility_index = defaultdict(dict)
-
-    for satellite in satellite_pool:
-        sat_id = satellite['satellite_id']
-        for point in satellite['time_series']:
-            timestamp = point['timestamp']
-            visibility_index[timestamp][sat_id] = {
-                'elevation_deg': point['visibility_metrics']['elevation_deg'],
-                'azimuth_deg': point['visibility_metrics']['azimuth_deg'],
-                'distance_km': point['visibility_metrics']['distance_km'],
-                'is_visible': point['visibility_metrics']['is_connectable'] == 'True'
-            }
-
-    return time_points, visibility_index
-
-def generate_full_orbit_timeseries(starlink_pool, time_points, visibility_index):
-    """
-    生成每顆衛星的完整軌道週期時間序列
-
-    完整週期 = 可見時段 + 不可見時段（填充）
-    """
-    print("\n🛰️  生成完整軌道週期數據...")
-
-    satellites_data = []
-
-    # 計算時間步長（秒）
-    if len(time_points) >= 2:
-        t1 = datetime.fromisoformat(time_points[0].replace('+00:00', ''))
-        t2 = datetime.fromisoformat(time_points[1].replace('+00:00', ''))
-        time_step_seconds = int((t2 - t1).total_seconds())
-    else:
-        time_step_seconds = 30
-
-    print(f"   時間步長: {time_step_seconds} 秒")
-    print(f"   軌道週期: {len(time_points)} 個時間點 ({len(time_points) * time_step_seconds / 60:.1f} 分鐘)")
-
-    # 為每顆衛星生成完整時間序列
-    for sat_idx, satellite in enumerate(starlink_pool, 1):
-        sat_id = satellite['satellite_id']
-
-        position_timeseries = []
-        visible_count = 0
-        max_elevation = 0.0
-
-        for time_idx, timestamp in enumerate(time_points):
-            # 計算時間偏移（秒）
-            time_offset_seconds = time_idx * time_step_seconds
-
-            # 檢查這顆衛星在這個時間點是否可見
-            if sat_id in visibility_index[timestamp]:
-                # 可見：使用實際數據
-                vis_data = visibility_index[timestamp][sat_id]
-                is_visible = True
-                visible_count += 1
-                max_elevation = max(max_elevation, vis_data['elevation_deg'])
-
-                position_timeseries.append({
-                    'time': timestamp,
-                    'time_offset_seconds': time_offset_seconds,
-                    'elevation_deg': round(vis_data['elevation_deg'], 2),
-                    'azimuth_deg': round(vis_data['azimuth_deg'], 2),
-                    'range_km': round(vis_data['distance_km'], 2),
-                    'is_visible': True
-                })
-            else:
-                # 不可見：填充默認值
-                position_timeseries.append({
-                    'time': timestamp,
-                    'time_offset_seconds': time_offset_seconds,
-                    'elevation_deg': -90.0,  # 地平線以下
-                    'azimuth_deg': 0.0,
-                    'range_km': 9999.0,  # 遠距離
-                    'is_visible': False
-                })
-
-        # 計算可見百分比
-        visible_percentage = (visible_count / len(time_points) * 100) if len(time_points) > 0 else 0
-
-        satellites_data.append({
-            'id': sat_id,
-            'name': satellite['name'],
-            'constellation': 'starlink',
-            'config': {
-                'min_elevation_deg': 5.0,
-                'time_step_seconds': time_step_seconds,
-                'time_points': len(time_points)
-            },
-            'statistics': {
-                'visible_points': visible_count,
-                'visible_percentage': round(visible_percentage, 2),
-                'max_elevation': round(max_elevation, 2)
-            },
-            'position_timeseries': position_timeseries
-        })
-
-        if sat_idx % 10 == 0:
-            print(f"   [{sat_idx}/{len(starlink_pool)}] 處理中...")
+    return satellite_pool, stats, constellation
 
-    print(f"   ✓ 完成 {len(satellites_data)} 顆衛星")
+def _cache_file(orbit_engine_file: Path, mtime_ns: int, size: int, constellation: str) -> Path:
+    """以 (路徑, 修改時間, 大小, 星座) 計算快取文件路徑"""
+    key = f"{orbit_engine_file.resolve()}:{mtime_ns}:{size}:{constellation}:v{CACHE_VERSION}"
+    return cache_file_for(key)
 
-    return satellites_data, time_step_seconds, len(time_points)
+@functools.cache
+def _load_time_index_cached(orbit_engine_file: Path, mtime_ns: int, size: int, constellation: str):
+    """從磁碟快取載入時間軸索引，未命中時解析 Stage 4 輸出並寫入快取"""
+    cache_file = _cache_file(orbit_engine_file, mtime_ns, size, constellation)
 
-def verify_coverage(satellites_data, time_step_seconds):
-    """驗證覆蓋率是否符合 10-15 顆目標"""
-    print("\n📊 驗證覆蓋率...")
+    if cache_file.exists():
+        print(f"⚡ 使用快取: {cache_file}")
+        with open(cache_file, 'rb') as f:
+            return pickle.load(f)
 
-    if not satellites_data:
-        print("   ❌ 無衛星數據")
-        return
+    satellite_pool, stats, _ = load_orbit_engine_data(orbit_engine_file, constellation)
+    time_points, satellites, visibility_matrices = build_time_index(satellite_pool)
+    result = (time_points, satellites, visibility_matrices, stats)
 
-    total_time_points = satellites_data[0]['config']['time_points']
-    visible_counts = []
+    write_cache(cache_file, result)
 
-    for time_idx in range(total_time_points):
-        count = sum(1 for sat in satellites_data
-                   if sat['position_timeseries'][time_idx]['is_visible'])
-        visible_counts.append(count)
+    return result
 
-    avg_visible = sum(visible_counts) / len(visible_counts)
-    min_visible = min(visible_counts)
-    max_visible = max(visible_counts)
+def load_time_index(constellation='starlink', use_cache=True):
+    """
+    載入 Stage 4 輸出並構建時間軸索引
 
-    # 計算滿足 10-15 顆目標的時間點比例
-    target_met = sum(1 for c in visible_counts if 10 <= c <= 15)
-    target_met_rate = target_met / total_time_points
+    快取以輸入文件的路徑、修改時間與大小為鍵，輸入未變時跳過 JSON 解析。
 
-    print(f"   平均可見: {avg_visible:.1f} 顆")
-    print(f"   範圍: {min_visible}-{max_visible} 顆")
-    print(f"   目標達成率: {target_met_rate*100:.1f}% ({target_met}/{total_time_points} 時間點)")
+    返回：(time_points, satellites, visibility_matrices, orbit_stats)
+    """
+    orbit_engine_file = find_latest_orbit_engine_output()
 
-    if 10 <= avg_visible <= 15 and target_met_rate >= 0.95:
-        print("   ✅ 符合目標（10-15 顆，95%+ 覆蓋率）")
-    else:
-        print("   ⚠️  未完全達標")
+    if not use_cache:
+        satellite_pool, stats, _ = load_orbit_engine_data(orbit_engine_file, constellation)
+        return (*build_time_index(satellite_pool), stats)
 
-    return {
-        'avg_visible': avg_visible,
-        'min_visible': min_visible,
-        'max_visible': max_visible,
-        'target_met_rate': target_met_rate
-    }
+    stat = orbit_engine_file.stat()
+    return _load_time_index_cached(orbit_engine_file, stat.st_mtime_ns, stat.st_size, constellation)
 
 def main():
     # 解析命令行參數
@@ -230,6 +127,7 @@ def main():
   %(prog)s --constellation starlink
   %(prog)s --constellation oneweb
   %(prog)s --all              # 生成所有星座數據
+  %(prog)s --format both      # 同時輸出 JSON 與 MessagePack
         """
     )
     parser.add_argument(
@@ -243,6 +141,17 @@ def main():
         action='store_true',
         help='生成所有星座數據'
     )
+    parser.add_argument(
+        '--no-cache',
+        action='store_true',
+        help='忽略快取，重新解析 orbit-engine 輸出'
+    )
+    parser.add_argument(
+        '--format', '-f',
+        choices=['json', 'msgpack', 'both'],
+        default='json',
+        help='輸出格式：json、msgpack（同名 .msgpack 文件）或 both (預設: json)'
+    )
     args = parser.parse_args()
 
     # 決定要處理的星座
@@ -257,34 +166,32 @@ def main():
         print(f"📡 轉換 orbit-engine 數據為前端時間序列格式 ({constellation.upper()})")
         print("=" * 60)
 
-        # 1. 載入數據
-        satellite_pool, orbit_stats, const_name = load_orbit_engine_data(constellation)
-
-        # 2. 構建時間軸索引
-        time_points, visibility_index = build_time_index(satellite_pool)
-
-        # 3. 生成完整軌道週期數據
-        satellites_data, time_step_seconds, total_time_points = generate_full_orbit_timeseries(
-            satellite_pool, time_points, visibility_index
+        # 1-2. 載入數據並構建時間軸索引（輸入未變時使用快取）
+        time_points, satellite_pool, visibility_matrices, orbit_stats = load_time_index(
+            constellation, use_cache=not args.no_cache
         )
 
-        # 4. 驗證覆蓋率
-        coverage_stats = verify_coverage(satellites_data, time_step_seconds)
+        time_step_seconds = compute_time_step(time_points)
+        total_time_points = len(time_points)
+
+        # 3. 驗證覆蓋率
+        coverage_stats = verify_coverage(satellite_pool, visibility_matrices)
 
-        # 5. 生成輸出 JSON
-        output_data = {
+        # 4. 輸出 JSON 的檔頭（衛星數據隨後逐顆串流寫出）
+        header = {
             'metadata': {
                 'generated_at': datetime.now().isoformat(),
                 'generator': 'convert_orbit_engine_to_timeseries.py',
-                'description': f'NTPU {const_name.upper()} 衛星完整軌道週期數據（基於 orbit-engine Stage 4）',
+                'description': f'NTPU {constellation.upper()} 衛星完整軌道週期數據（基於 orbit-engine Stage 4）',
                 'source': 'orbit-engine Stage 4 pool_optimization',
-                'constellation': const_name,
+                'constellation': constellation,
                 'orbit_period_minutes': total_time_points * time_step_seconds / 60,
+                'scale': VALUE_SCALE,
                 'warning': '⚠️ 此數據包含完整軌道週期（可見+不可見時段），前端循環播放此週期'
             },
             'statistics': {
-                'total_satellites': len(satellites_data),
-                'constellation': const_name,
+                'total_satellites': len(satellite_pool),
+                'constellation': constellation,
                 'time_points': total_time_points,
                 'time_step_seconds': time_step_seconds,
                 'orbit_period_minutes': total_time_points * time_step_seconds / 60,
@@ -292,24 +199,39 @@ def main():
                 'visible_range': [coverage_stats['min_visible'], coverage_stats['max_visible']],
                 'target_met_rate': coverage_stats['target_met_rate']
             },
-            'satellites': satellites_data
+            'time_axis': format_timestamps(time_points)
         }
 
-        # 6. 保存到文件
-        output_file = PROJECT_ROOT / f"public/data/satellite-timeseries-{const_name}.json"
-        print(f"\n💾 保存數據到: {output_file}")
+        # 5. 生成完整軌道週期數據並逐顆保存到文件
+        #    （--format both 時兩種格式共用同一次生成）
+        output_file = PROJECT_ROOT / f"public/data/satellite-timeseries-{constellation}.json"
+        msgpack_file = output_file.with_suffix('.msgpack')
         output_file.parent.mkdir(parents=True, exist_ok=True)
 
-        with open(output_file, 'w', encoding='utf-8') as f:
-            json.dump(output_data, f, indent=2, ensure_ascii=False)
-
-        file_size = output_file.stat().st_size / 1024 / 1024  # MB
-        print(f"   ✓ 保存成功 ({file_size:.2f} MB)")
-
-        # 7. 最終摘要
+        output_files = {
+            'json': [output_file],
+            'msgpack': [msgpack_file],
+            'both': [output_file, msgpack_file]
+        }[args.format]
+        for path in output_files:
+            print(f"\n💾 保存數據到: {path}")
+
+        satellites = generate_full_orbit_timeseries(satellite_pool, time_points, visibility_matrices, time_step_seconds)
+        if args.format == 'json':
+            write_timeseries_json(output_file, header, satellites)
+        elif args.format == 'msgpack':
+            write_timeseries_msgpack(msgpack_file, header, satellites)
+        else:
+            write_timeseries_json_and_msgpack(output_file, msgpack_file, header, satellites)
+
+        for path in output_files:
+            file_size = path.stat().st_size / 1024 / 1024  # MB
+            print(f"   ✓ 保存成功 {path.name} ({file_size:.2f} MB)")
+
+        # 6. 最終摘要
         print(f"\n✅ 轉換完成！")
-        print(f"   星座: {const_name.upper()}")
-        print(f"   衛星數量: {len(satellites_data)} 顆")
+        print(f"   星座: {constellation.upper()}")
+        print(f"   衛星數量: {len(satellite_pool)} 顆")
         print(f"   軌道週期: {total_time_points * time_step_seconds / 60:.1f} 分鐘 ({total_time_points} 個時間點)")
         print(f"   平均可見: {coverage_stats['avg_visible']:.1f} 顆 (範圍 {coverage_stats['min_visible']}-{coverage_stats['max_visible']})")
         print("=" * 60)
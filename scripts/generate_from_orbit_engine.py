@@ -4,10 +4,29 @@
 提取候選池中的衛星，使用 Skyfield 生成包含可見和不可見時段的完整數據
 """
 
-import json
+import functools
+import os
+import pickle
+import ijson
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime, timezone
 from pathlib import Path
 from skyfield.api import load, wgs84, EarthSatellite
+from skyfield.constants import AU_KM
+from skyfield.functions import mxv, to_spherical
+
+from _orbit_ts_core import (
+    build_time_array,
+    cache_file_for,
+    find_latest_orbit_engine_output,
+    init_worker,
+    iter_tle_records,
+    report_progress,
+    worker_state,
+    write_cache,
+    write_timeseries_json,
+)
 
 # ==================== 配置參數 ====================
 
@@ -22,60 +41,77 @@ DURATION_HOURS = 2        # 計算時長（小時）- 2小時足以觀察動態
 
 # 文件路徑
 PROJECT_ROOT = Path(__file__).parent.parent
-ORBIT_ENGINE_STAGE4_DIR = Path("/home/sat/satellite/orbit-engine/data/outputs/stage4")
 STARLINK_TLE_DIR = Path("/home/sat/satellite/tle_data/starlink/tle")
 ONEWEB_TLE_DIR = Path("/home/sat/satellite/tle_data/oneweb/tle")
 OUTPUT_FILE = PROJECT_ROOT / "public/data/satellite-timeseries.json"
 
-def find_latest_orbit_engine_output():
-    """自動找到 stage4 目錄中最新的輸出文件"""
-    json_files = list(ORBIT_ENGINE_STAGE4_DIR.glob("link_feasibility_output_*.json"))
-
-    if not json_files:
-        raise FileNotFoundError(f"在 {ORBIT_ENGINE_STAGE4_DIR} 中找不到 orbit-engine 輸出文件")
-
-    # 按修改時間排序，取最新的
-    latest_file = max(json_files, key=lambda p: p.stat().st_mtime)
-    print(f"📂 自動選擇最新的 orbit-engine 輸出: {latest_file.name}")
-    return latest_file
-
 # ==================== 讀取 orbit-engine 輸出 ====================
 
 def load_satellite_pool(orbit_engine_file: Path):
-    """從 orbit-engine Stage 4 輸出載入衛星池"""
+    """從 orbit-engine Stage 4 輸出載入衛星池（輸入未變時使用快取）"""
     print(f"📂 讀取 orbit-engine 輸出: {orbit_engine_file}")
 
-    with open(orbit_engine_file, 'r') as f:
-        data = json.load(f)
+    stat = orbit_engine_file.stat()
+    satellite_ids = _load_satellite_ids_cached(orbit_engine_file, stat.st_mtime_ns, stat.st_size)
+
+    print(f"   ✓ Starlink 衛星: {len(satellite_ids['starlink'])} 顆")
+    print(f"   ✓ OneWeb 衛星: {len(satellite_ids['oneweb'])} 顆")
+
+    return satellite_ids
+
+@functools.cache
+def _load_satellite_ids_cached(orbit_engine_file: Path, mtime_ns: int, size: int):
+    """以 (路徑, 修改時間, 大小) 為鍵的磁碟快取，未命中時解析 Stage 4 輸出"""
+    key = f"{orbit_engine_file.resolve()}:{mtime_ns}:{size}:satellite_ids"
+    cache_file = cache_file_for(key)
 
-    pool_data = data.get('pool_optimization', {}).get('optimized_pools', {})
+    if cache_file.exists():
+        print(f"   ⚡ 使用快取: {cache_file}")
+        with open(cache_file, 'rb') as f:
+            return pickle.load(f)
 
     satellite_ids = {
         'starlink': [],
         'oneweb': []
     }
 
-    # 提取 Starlink 衛星 ID
-    if 'starlink' in pool_data and isinstance(pool_data['starlink'], list):
-        for sat in pool_data['starlink']:
-            sat_id = sat.get('satellite_id')
-            if sat_id:
-                satellite_ids['starlink'].append(sat_id)
+    # 串流解析，只提取各星座候選池的衛星 ID（不載入整份 JSON）
+    id_prefixes = {
+        f'pool_optimization.optimized_pools.{constellation}.item.satellite_id': constellation
+        for constellation in satellite_ids
+    }
 
-    # 提取 OneWeb 衛星 ID
-    if 'oneweb' in pool_data and isinstance(pool_data['oneweb'], list):
-        for sat in pool_data['oneweb']:
-            sat_id = sat.get('satellite_id')
-            if sat_id:
-                satellite_ids['oneweb'].append(sat_id)
+    with open(orbit_engine_file, 'rb') as f:
+        for prefix, event, value in ijson.parse(f):
+            if event == 'string' and prefix in id_prefixes and value:
+                satellite_ids[id_prefixes[prefix]].append(value)
 
-    print(f"   ✓ Starlink 衛星: {len(satellite_ids['starlink'])} 顆")
-    print(f"   ✓ OneWeb 衛星: {len(satellite_ids['oneweb'])} 顆")
+    write_cache(cache_file, satellite_ids)
 
     return satellite_ids
 
 # ==================== 讀取 TLE 數據 ====================
 
+def load_constellation_tle(tle_file: Path, satellite_ids, constellation: str, min_elevation: float):
+    """從 TLE 文件中挑出候選池內的衛星"""
+    wanted = set(satellite_ids)
+    tle_data = {}
+
+    for name, line1, line2 in iter_tle_records(tle_file):
+        # 衛星編號位於第1行固定欄位（第 3-7 欄），不需 split 整行
+        sat_number = line1[2:7].strip()
+
+        if sat_number in wanted:
+            tle_data[sat_number] = {
+                'name': name,
+                'line1': line1,
+                'line2': line2,
+                'constellation': constellation,
+                'min_elevation': min_elevation
+            }
+
+    return tle_data
+
 def load_tle_for_satellites(satellite_ids: dict):
     """載入指定衛星的 TLE 數據"""
     print(f"\n📡 載入 TLE 數據...")
@@ -86,104 +122,70 @@ def load_tle_for_satellites(satellite_ids: dict):
     latest_starlink_tle = sorted(STARLINK_TLE_DIR.glob("starlink_*.tle"))[-1]
     print(f"   使用 Starlink TLE: {latest_starlink_tle.name}")
 
-    with open(latest_starlink_tle, 'r') as f:
-        lines = [line.strip() for line in f if line.strip()]
-
-    # 解析 TLE（每3行一組）
-    for i in range(0, len(lines), 3):
-        if i + 2 < len(lines):
-            name = lines[i]
-            line1 = lines[i + 1]
-            line2 = lines[i + 2]
-
-            # 提取衛星編號
-            sat_number = line1.split()[1].rstrip('U')
-
-            if sat_number in satellite_ids['starlink']:
-                tle_data[sat_number] = {
-                    'name': name,
-                    'line1': line1,
-                    'line2': line2,
-                    'constellation': 'starlink',
-                    'min_elevation': 5.0  # Starlink 使用 5° 門檻
-                }
+    # Starlink 使用 5° 門檻
+    tle_data.update(load_constellation_tle(latest_starlink_tle, satellite_ids['starlink'], 'starlink', 5.0))
 
     # 載入 OneWeb TLE
     if satellite_ids['oneweb']:
         latest_oneweb_tle = sorted(ONEWEB_TLE_DIR.glob("oneweb_*.tle"))[-1]
         print(f"   使用 OneWeb TLE: {latest_oneweb_tle.name}")
 
-        with open(latest_oneweb_tle, 'r') as f:
-            lines = [line.strip() for line in f if line.strip()]
-
-        for i in range(0, len(lines), 3):
-            if i + 2 < len(lines):
-                name = lines[i]
-                line1 = lines[i + 1]
-                line2 = lines[i + 2]
-
-                sat_number = line1.split()[1].rstrip('U')
-
-                if sat_number in satellite_ids['oneweb']:
-                    tle_data[sat_number] = {
-                        'name': name,
-                        'line1': line1,
-                        'line2': line2,
-                        'constellation': 'oneweb',
-                        'min_elevation': 10.0  # OneWeb 使用 10° 門檻
-                    }
+        # OneWeb 使用 10° 門檻
+        tle_data.update(load_constellation_tle(latest_oneweb_tle, satellite_ids['oneweb'], 'oneweb', 10.0))
 
     print(f"   ✓ 成功載入 {len(tle_data)} 顆衛星的 TLE 數據")
     return tle_data
 
 # ==================== 計算衛星時間序列 ====================
 
-def calculate_satellite_timeseries(sat_id, tle, observer_pos, ts, start_time):
-    """計算單顆衛星的完整軌道週期數據"""
+@functools.cache
+def get_timescale():
+    """載入 Skyfield 時間尺度（每個進程只載入一次）"""
+    return load.timescale()
 
-    # 創建 Skyfield 衛星對象
-    satellite = EarthSatellite(tle['line1'], tle['line2'], tle['name'], ts)
+@functools.lru_cache(maxsize=None)
+def make_earth_satellite(line1: str, line2: str, name: str):
+    """以 TLE 兩行建立 Skyfield 衛星對象，相同 TLE 重複呼叫時直接重用已解析的 SGP4 記錄"""
+    return EarthSatellite(line1, line2, name, get_timescale())
 
-    # 計算時間點數
-    time_points = (DURATION_HOURS * 3600) // TIME_STEP_SECONDS
+def prepare_observer_frames(observer_pos, times):
+    """
+    預先計算觀測點相關的座標轉換（所有衛星共用）
+
+    - observer_gcrs: 觀測點 GCRS 位置 (3, T)，單位 AU
+    - gcrs_to_altaz: GCRS → 觀測點地平座標旋轉矩陣 (3, 3, T)
+    """
+    return {
+        'observer_gcrs': observer_pos.at(times).xyz.au,
+        'gcrs_to_altaz': observer_pos.rotation_at(times)
+    }
+
+def calculate_satellite_timeseries(sat_id, tle, times, frames):
+    """
+    計算單顆衛星的完整軌道週期數據
 
-    # 生成時間序列
-    timeseries = []
-    visible_count = 0
-    max_elevation = 0.0
+    位置數據以 float32 SoA 陣列存放於 'position_arrays'（跨進程傳遞時體積小），
+    輸出前再由 build_position_timeseries 轉為逐點格式
+    """
+
+    # 創建 Skyfield 衛星對象（依 TLE 快取）
+    satellite = make_earth_satellite(tle['line1'], tle['line2'], tle['name'])
+
+    # 計算時間點數
+    time_points = len(times)
     min_elevation = tle['min_elevation']
 
-    for i in range(time_points):
-        # 計算當前時間
-        offset_seconds = i * TIME_STEP_SECONDS
-        current_time = ts.ut1_jd(start_time.ut1 + offset_seconds / 86400.0)
-
-        # 計算衛星相對於觀測點的位置
-        difference = satellite - observer_pos
-        topocentric = difference.at(current_time)
-
-        # 計算仰角、方位角、距離
-        alt, az, distance = topocentric.altaz()
-
-        elevation_deg = alt.degrees
-        azimuth_deg = az.degrees
-        range_km = distance.km
-        is_visible = elevation_deg >= min_elevation
-
-        # 統計
-        if is_visible:
-            visible_count += 1
-            max_elevation = max(max_elevation, elevation_deg)
-
-        # 添加數據點（確保所有值都是 Python 原生類型）
-        timeseries.append({
-            'time': current_time.utc_iso(),
-            'time_offset_seconds': int(offset_seconds),
-            'elevation_deg': float(round(elevation_deg, 2)),
-            'azimuth_deg': float(round(azimuth_deg, 2)),
-            'range_km': float(round(range_km, 2)),
-            'is_visible': bool(is_visible)
-        })
+    # 計算衛星相對於觀測點的仰角、方位角、距離（皆為陣列）
+    # 與 (satellite - observer_pos).at(times).altaz() 相同，但觀測點位置與旋轉矩陣共用預先計算結果
+    topocentric = satellite.at(times).xyz.au - frames['observer_gcrs']
+    distance_au, alt, az = to_spherical(mxv(frames['gcrs_to_altaz'], topocentric))
+
+    elevation_deg = np.degrees(alt)
+    visible_mask = elevation_deg >= min_elevation
+
+    # 統計
+    visible_count = int(visible_mask.sum())
+    max_elevation = float(elevation_deg[visible_mask].max(initial=0.0))
 
     # 計算可見百分比
     visible_percentage = (visible_count / time_points * 100) if time_points > 0 else 0
@@ -202,9 +204,58 @@ def calculate_satellite_timeseries(sat_id, tle, observer_pos, ts, start_time):
             'visible_percentage': round(visible_percentage, 2),
             'max_elevation': round(max_elevation, 2)
         },
-        'position_timeseries': timeseries
+        'position_arrays': {
+            'elevation_deg': elevation_deg.astype(np.float32),
+            'azimuth_deg': np.degrees(az).astype(np.float32),
+            'range_km': (distance_au * AU_KM).astype(np.float32),
+            'is_visible': visible_mask
+        }
     }
 
+def build_position_timeseries(sat_data):
+    """
+    輸出前將 position_arrays 轉為逐點格式的 position_timeseries
+
+    數值只在此時四捨五入到 2 位小數，並以 .tolist() 一次轉為 Python 原生類型
+    ISO 時間不逐點存放，統一由輸出的 time_axis 提供
+    """
+    arrays = sat_data.pop('position_arrays')
+    time_step_seconds = sat_data['config']['time_step_seconds']
+
+    sat_data['position_timeseries'] = [
+        {
+            'time_offset_seconds': time_idx * time_step_seconds,
+            'elevation_deg': elev,
+            'azimuth_deg': azim,
+            'range_km': rng,
+            'is_visible': is_visible
+        }
+        for time_idx, (elev, azim, rng, is_visible) in enumerate(zip(
+            np.round(arrays['elevation_deg'].astype(np.float64), 2).tolist(),
+            np.round(arrays['azimuth_deg'].astype(np.float64), 2).tolist(),
+            np.round(arrays['range_km'].astype(np.float64), 2).tolist(),
+            arrays['is_visible'].tolist()
+        ))
+    ]
+
+    return sat_data
+
+# ==================== 平行計算 ====================
+
+def _setup_worker(start_ut1):
+    """子進程初始化：重建時間尺度與時間陣列，並預先計算觀測點的座標轉換"""
+    ts = get_timescale()
+    times = build_time_array(
+        ts, ts.ut1_jd(start_ut1), (DURATION_HOURS * 3600) // TIME_STEP_SECONDS, TIME_STEP_SECONDS
+    )
+    observer_pos = wgs84.latlon(OBSERVER_LAT, OBSERVER_LON, elevation_m=OBSERVER_ALT)
+    return {'times': times, 'frames': prepare_observer_frames(observer_pos, times)}
+
+def _calculate_satellite_worker(task):
+    """子進程工作函數：計算單顆衛星的時間序列"""
+    sat_id, tle = task
+    return calculate_satellite_timeseries(sat_id, tle, worker_state['times'], worker_state['frames'])
+
 # ==================== 主程序 ====================
 
 def main():
@@ -220,10 +271,9 @@ def main():
     # 2. 載入 TLE 數據
     tle_data = load_tle_for_satellites(satellite_ids)
 
-    # 3. 創建 Skyfield 時間尺度和觀測點
-    ts = load.timescale()
+    # 3. 創建 Skyfield 時間尺度（觀測點由各子進程在初始化時建立）
+    ts = get_timescale()
     start_time = ts.now()
-    observer_pos = wgs84.latlon(OBSERVER_LAT, OBSERVER_LON, elevation_m=OBSERVER_ALT)
 
     print(f"\n⏰ 計算時間範圍:")
     print(f"   起始時間: {start_time.utc_iso()}")
@@ -231,30 +281,17 @@ def main():
     print(f"   時間步長: {TIME_STEP_SECONDS} 秒")
     print(f"   總時間點: {(DURATION_HOURS * 3600) // TIME_STEP_SECONDS}")
 
+    # 所有衛星共用的時間軸（ISO 字串只生成一次）
+    time_axis = build_time_array(
+        ts, start_time, (DURATION_HOURS * 3600) // TIME_STEP_SECONDS, TIME_STEP_SECONDS
+    ).utc_iso()
+
     print(f"\n📍 觀測點: NTPU")
     print(f"   經緯度: ({OBSERVER_LAT}, {OBSERVER_LON})")
     print(f"   海拔: {OBSERVER_ALT} m")
 
-    # 4. 計算每顆衛星
-    print(f"\n🛰️  計算衛星位置...")
-    satellites_data = []
-    visible_satellites_count = 0
-
-    for sat_id, tle in tle_data.items():
-        idx = len(satellites_data) + 1
-        print(f"   [{idx}/{len(tle_data)}] {tle['constellation'].upper()} {sat_id}...", end=' ')
-
-        sat_data = calculate_satellite_timeseries(sat_id, tle, observer_pos, ts, start_time)
-        satellites_data.append(sat_data)
-
-        if sat_data['statistics']['visible_points'] > 0:
-            visible_satellites_count += 1
-            print(f"✓ ({sat_data['statistics']['visible_percentage']:.1f}% 可見)")
-        else:
-            print("⚠️  (不可見)")
-
-    # 5. 生成輸出 JSON
-    output_data = {
+    # 4. 輸出 JSON 的檔頭（統計依賴逐顆計算結果，寫在衛星數據之後）
+    header = {
         'metadata': {
             'generated_at': datetime.now(timezone.utc).isoformat(),
             'generator': 'generate_from_orbit_engine.py',
@@ -262,33 +299,52 @@ def main():
             'source': 'orbit-engine Stage 4 output + Skyfield SGP4 propagation',
             'warning': '⚠️ 此數據基於 TLE epoch 時間計算，包含完整軌道週期（可見+不可見時段）'
         },
-        'statistics': {
-            'total_satellites': len(tle_data),
-            'processed_satellites': len(satellites_data),
-            'visible_satellites': visible_satellites_count,
-            'starlink_count': len(satellite_ids['starlink']),
-            'oneweb_count': len(satellite_ids['oneweb'])
-        },
-        'satellites': satellites_data
+        'time_axis': time_axis
     }
-
-    # 6. 保存到文件
-    print(f"\n💾 保存數據到: {OUTPUT_FILE}")
+    counters = {'processed': 0, 'visible': 0}
+
+    def footer():
+        return {
+            'statistics': {
+                'total_satellites': len(tle_data),
+                'processed_satellites': counters['processed'],
+                'visible_satellites': counters['visible'],
+                'starlink_count': len(satellite_ids['starlink']),
+                'oneweb_count': len(satellite_ids['oneweb'])
+            }
+        }
+
+    # 5. 計算每顆衛星（各衛星互相獨立，分散到多個 CPU 核心），結果逐顆寫入文件
+    print(f"\n🛰️  計算衛星位置（{os.cpu_count()} 個進程）...")
+    print(f"   💾 輸出文件: {OUTPUT_FILE}")
     OUTPUT_FILE.parent.mkdir(parents=True, exist_ok=True)
 
-    with open(OUTPUT_FILE, 'w', encoding='utf-8') as f:
-        json.dump(output_data, f, indent=2, ensure_ascii=False)
+    with ProcessPoolExecutor(
+        max_workers=os.cpu_count(),
+        initializer=init_worker,
+        initargs=(_setup_worker, start_time.ut1)
+    ) as executor:
+        try:
+            results = executor.map(_calculate_satellite_worker, tle_data.items(), chunksize=4)
+            progress = report_progress(
+                results, len(tle_data), counters, lambda sat: f"{sat['constellation'].upper()} {sat['id']}"
+            )
+            write_timeseries_json(OUTPUT_FILE, header, map(build_position_timeseries, progress), footer)
+        except BaseException:
+            # 計算失敗或中斷時取消尚未開始的工作，立即結束（原輸出文件保持不變）
+            executor.shutdown(cancel_futures=True)
+            raise
 
     file_size = OUTPUT_FILE.stat().st_size / 1024 / 1024  # MB
     print(f"   ✓ 保存成功 ({file_size:.2f} MB)")
 
-    # 7. 統計摘要
+    # 6. 統計摘要
     print(f"\n📊 生成摘要:")
     print(f"   總衛星數: {len(tle_data)}")
     print(f"   Starlink: {len(satellite_ids['starlink'])}")
     print(f"   OneWeb: {len(satellite_ids['oneweb'])}")
-    print(f"   可見衛星: {visible_satellites_count}")
-    print(f"   數據點數: {len(satellites_data) * ((DURATION_HOURS * 3600) // TIME_STEP_SECONDS)}")
+    print(f"   可見衛星: {counters['visible']}")
+    print(f"   數據點數: {counters['processed'] * ((DURATION_HOURS * 3600) // TIME_STEP_SECONDS)}")
 
     print("\n✅ 完成！")
     print("=" * 60)
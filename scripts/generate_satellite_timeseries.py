@@ -4,12 +4,28 @@
 使用 Skyfield 計算 NTPU 觀測點的衛星位置
 """
 
-import json
+import os
+from itertools import chain
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime, timezone, timedelta
 from pathlib import Path
-from skyfield.api import load, wgs84, EarthSatellite
+from sgp4.api import Satrec, SatrecArray
+from skyfield.api import load, wgs84
+from skyfield.constants import AU_KM, DAY_S
+from skyfield.functions import to_spherical
+from skyfield.sgp4lib import TEME
 from skyfield.toposlib import GeographicPosition
 
+from _orbit_ts_core import (
+    build_time_array,
+    init_worker,
+    iter_tle_records,
+    report_progress,
+    worker_state,
+    write_timeseries_json,
+)
+
 # ==================== 配置參數 ====================
 
 # NTPU 觀測點
@@ -21,6 +37,7 @@ OBSERVER_ALT = 50  # 海拔 50 米
 MIN_ELEVATION_DEG = 0.0   # 最小仰角（設為0以顯示所有衛星）
 TIME_STEP_SECONDS = 30    # 時間步長（秒）
 DURATION_HOURS = 24       # 計算時長（小時）
+SGP4_BATCH_SIZE = 256     # 每批同時傳播的衛星數上限（限制 S×T×3 陣列的記憶體用量）
 
 # 文件路徑
 PROJECT_ROOT = Path(__file__).parent.parent
@@ -29,94 +46,110 @@ OUTPUT_FILE = PROJECT_ROOT / "public/data/satellite-timeseries.json"
 
 # ==================== 讀取 TLE 數據 ====================
 
-def read_tle_data(tle_file: Path):
-    """讀取 TLE 文件，返回衛星列表"""
-    satellites = []
-
-    with open(tle_file, 'r') as f:
-        lines = [line.strip() for line in f if line.strip()]
-
-    # TLE 格式：每3行為一組（名稱、第1行、第2行）
-    for i in range(0, len(lines), 3):
-        if i + 2 < len(lines):
-            name = lines[i]
-            line1 = lines[i + 1]
-            line2 = lines[i + 2]
-            satellites.append({
-                'name': name,
-                'line1': line1,
-                'line2': line2
-            })
+def read_tle_data(tle_file: Path, ts):
+    """
+    讀取 TLE 文件，返回衛星列表
+
+    衛星 ID 與 TLE epoch 在載入時一次解析完成，計算階段不再重複解析 TLE 文字：
+    - sat_id: 'sat-' + 衛星編號（line1 第 3–7 欄）
+    - tle_epoch: epoch 的 ISO 字串；epoch_utc: epoch 的 UTC datetime（計算 TLE 年齡用）
+    """
+    satellites = [
+        {'name': name, 'line1': line1, 'line2': line2, 'sat_id': f"sat-{line1[2:7].strip()}"}
+        for name, line1, line2 in iter_tle_records(tle_file)
+    ]
+
+    if not satellites:
+        return satellites
+
+    # 所有 epoch 以單一 Time 陣列計算（兩位數年份換算與 Skyfield EarthSatellite 相同：57–99 為 19xx）
+    satrecs = [Satrec.twoline2rv(sat['line1'], sat['line2']) for sat in satellites]
+    two_digit_years = np.array([satrec.epochyr for satrec in satrecs])
+    epochs = ts.utc(
+        np.where(two_digit_years < 57, 2000, 1900) + two_digit_years,
+        1,
+        np.array([satrec.epochdays for satrec in satrecs])
+    )
+
+    for sat, tle_epoch, epoch_utc in zip(satellites, epochs.utc_iso(), epochs.utc_datetime()):
+        sat['tle_epoch'] = tle_epoch
+        sat['epoch_utc'] = epoch_utc
 
     return satellites
 
 # ==================== 計算衛星位置 ====================
 
-def calculate_satellite_timeseries(tle_data, observer_pos, ts, start_time):
-    """計算單顆衛星的時間序列數據"""
+def prepare_frames(observer_pos, times):
+    """
+    預先計算只與時間有關的座標轉換（所有衛星共用）
+
+    - teme_to_altaz: TEME → 觀測點地平座標的合併旋轉矩陣 (3, 3, T)
+      （GCRS → 地平座標 × TEME → GCRS，兩次旋轉合併為一次）
+    - observer_altaz: 觀測點在地平座標中的位置 (3, T)，單位 km
+    - jd, fraction: SGP4 使用的 UTC 儒略日（與 Skyfield EarthSatellite 相同的拆分方式）
+    """
+    teme_to_gcrs = np.swapaxes(TEME.rotation_at(times), 0, 1)
+    gcrs_to_altaz = observer_pos.rotation_at(times)
+    observer_gcrs_km = observer_pos.at(times).xyz.au * AU_KM
+
+    return {
+        'teme_to_altaz': np.einsum('ijt,jkt->ikt', gcrs_to_altaz, teme_to_gcrs),
+        'observer_altaz': np.einsum('ijt,jt->it', gcrs_to_altaz, observer_gcrs_km),
+        'jd': times.whole,
+        'fraction': times.tai_fraction - times._leap_seconds() / DAY_S
+    }
+
+def propagate_satellites(tle_batch, frames):
+    """
+    以 SatrecArray 一次傳播一批衛星的所有時間點，並轉換為觀測點的仰角、方位角、距離
+
+    轉換結果與 Skyfield 的 (satellite - observer).at(t).altaz() 相同：
+    TEME 位置以合併後的旋轉矩陣一次轉到地平座標，再扣除觀測點位置
+
+    Returns:
+        (elevation_deg, azimuth_deg, range_km)，皆為 (衛星數, T) 陣列
+    """
+    satrecs = SatrecArray([Satrec.twoline2rv(tle['line1'], tle['line2']) for tle in tle_batch])
+    _, r_teme, _ = satrecs.sgp4(frames['jd'], frames['fraction'])
+
+    # r_teme: (S, T, 3) km → 地平座標 (3, S, T) km，逐時間點套用共用的旋轉矩陣
+    r_altaz = np.einsum('ijt,stj->ist', frames['teme_to_altaz'], r_teme) - frames['observer_altaz'][:, None, :]
 
-    # 創建 Skyfield 衛星對象
-    satellite = EarthSatellite(tle_data['line1'], tle_data['line2'], tle_data['name'], ts)
+    range_km, alt, az = to_spherical(r_altaz)
+    return np.degrees(alt), np.degrees(az), range_km
+
+def calculate_satellite_timeseries(tle_data, start_utc, elevation_deg, azimuth_deg, range_km):
+    """由批次傳播結果組裝單顆衛星的時間序列數據（ID、epoch 已由 read_tle_data 解析）"""
 
     # 計算時間點數
-    time_points = (DURATION_HOURS * 3600) // TIME_STEP_SECONDS
-
-    # 生成時間序列
-    timeseries = []
-    visible_count = 0
-    max_elevation = 0.0
-
-    for i in range(time_points):
-        # 計算當前時間
-        offset_seconds = i * TIME_STEP_SECONDS
-        current_time = ts.ut1_jd(start_time.ut1 + offset_seconds / 86400.0)
-
-        # 計算衛星相對於觀測點的位置
-        difference = satellite - observer_pos
-        topocentric = difference.at(current_time)
-
-        # 計算仰角、方位角、距離
-        alt, az, distance = topocentric.altaz()
-
-        elevation_deg = alt.degrees
-        azimuth_deg = az.degrees
-        range_km = distance.km
-        is_visible = elevation_deg >= MIN_ELEVATION_DEG
-
-        # 統計
-        if is_visible:
-            visible_count += 1
-            max_elevation = max(max_elevation, elevation_deg)
-
-        # 添加數據點（確保所有值都是 Python 原生類型）
-        timeseries.append({
-            'time': current_time.utc_iso(),
-            'time_offset_seconds': int(offset_seconds),
-            'elevation_deg': float(round(elevation_deg, 2)),
-            'azimuth_deg': float(round(azimuth_deg, 2)),
-            'range_km': float(round(range_km, 2)),
-            'is_visible': bool(is_visible)
-        })
+    time_points = len(elevation_deg)
+
+    visible_mask = elevation_deg >= MIN_ELEVATION_DEG
+
+    # 統計
+    visible_count = int(visible_mask.sum())
+    max_elevation = float(elevation_deg[visible_mask].max(initial=0.0))
+
+    # 生成時間序列（SoA：各欄位為平行陣列，第 i 個元素對應 start_time + i * time_step_seconds）
+    # 保留 numpy 陣列，由 orjson（OPT_SERIALIZE_NUMPY）直接輸出，不逐元素轉為 Python 物件；
+    # 在 float64 下四捨五入後再轉為 float32（7 位有效數字足以精確表示兩位小數）
+    position_arrays = {
+        'elevation_deg': np.round(elevation_deg, 2).astype(np.float32),
+        'azimuth_deg': np.round(azimuth_deg, 2).astype(np.float32),
+        'range_km': np.round(range_km, 2).astype(np.float32),
+        'is_visible': visible_mask
+    }
 
     # 計算可見百分比
     visible_percentage = (visible_count / time_points * 100) if time_points > 0 else 0
 
-    # 提取衛星 ID（從 TLE line1）
-    sat_number = tle_data['line1'].split()[1].rstrip('U')
-    sat_id = f"sat-{sat_number}"
-
-    # TLE epoch
-    tle_epoch = satellite.epoch.utc_iso()
-
     # 計算 TLE 年齡
-    epoch_date = satellite.epoch.utc_datetime()
-    start_date = start_time.utc_datetime()
-    tle_age_days = (start_date - epoch_date).total_seconds() / 86400.0
+    tle_age_days = (start_utc - tle_data['epoch_utc']).total_seconds() / 86400.0
 
     return {
-        'id': sat_id,
+        'id': tle_data['sat_id'],
         'name': tle_data['name'],
-        'tle_epoch': tle_epoch,
+        'tle_epoch': tle_data['tle_epoch'],
         'tle_age_days': round(tle_age_days, 2),
         'observer': {
             'name': 'National Taipei University',
@@ -134,9 +167,34 @@ def calculate_satellite_timeseries(tle_data, observer_pos, ts, start_time):
             'visible_percentage': round(visible_percentage, 2),
             'max_elevation': round(max_elevation, 2)
         },
-        'position_timeseries': timeseries
+        'position_arrays': position_arrays
+    }
+
+# ==================== 平行計算 ====================
+
+def _setup_worker(start_ut1):
+    """子進程初始化：重建時間尺度、起始時間，並預先計算共用的時間陣列與座標轉換"""
+    ts = load.timescale()
+    start_time = ts.ut1_jd(start_ut1)
+    observer_pos = wgs84.latlon(OBSERVER_LAT, OBSERVER_LON, elevation_m=OBSERVER_ALT)
+    return {
+        'start_utc': start_time.utc_datetime(),
+        'frames': prepare_frames(
+            observer_pos,
+            build_time_array(ts, start_time, (DURATION_HOURS * 3600) // TIME_STEP_SECONDS, TIME_STEP_SECONDS)
+        )
     }
 
+def _calculate_batch_worker(tle_batch):
+    """子進程工作函數：傳播一批衛星並組裝各自的時間序列"""
+    elevation, azimuth, range_km = propagate_satellites(tle_batch, worker_state['frames'])
+    return [
+        calculate_satellite_timeseries(
+            tle, worker_state['start_utc'], elevation[row], azimuth[row], range_km[row]
+        )
+        for row, tle in enumerate(tle_batch)
+    ]
+
 # ==================== 主程序 ====================
 
 def main():
@@ -144,14 +202,14 @@ def main():
     print("📡 衛星時間序列數據生成器")
     print("=" * 60)
 
+    # 創建 Skyfield 時間尺度
+    ts = load.timescale()
+
     # 載入 TLE 數據
     print(f"\n📂 讀取 TLE 數據: {TLE_FILE}")
-    tle_satellites = read_tle_data(TLE_FILE)
+    tle_satellites = read_tle_data(TLE_FILE, ts)
     print(f"   ✓ 成功讀取 {len(tle_satellites)} 顆衛星")
 
-    # 創建 Skyfield 時間尺度
-    ts = load.timescale()
-
     # 使用 TLE epoch 時間作為起始時間
     # 這樣可以避免時間基準錯誤
     start_time = ts.now()
@@ -161,58 +219,67 @@ def main():
     print(f"   持續時長: {DURATION_HOURS} 小時")
     print(f"   時間步長: {TIME_STEP_SECONDS} 秒")
 
-    # 創建觀測點
-    observer_pos = wgs84.latlon(OBSERVER_LAT, OBSERVER_LON, elevation_m=OBSERVER_ALT)
+    # 觀測點（座標轉換由各子進程在初始化時建立）
     print(f"\n📍 觀測點: NTPU")
     print(f"   經緯度: ({OBSERVER_LAT}, {OBSERVER_LON})")
     print(f"   海拔: {OBSERVER_ALT} m")
     print(f"   最小仰角: {MIN_ELEVATION_DEG}°")
 
-    # 計算每顆衛星
-    print(f"\n🛰️  計算衛星位置...")
-    satellites_data = []
-    visible_satellites = 0
-
-    for idx, tle in enumerate(tle_satellites, 1):
-        print(f"   [{idx}/{len(tle_satellites)}] {tle['name']}...", end=' ')
-
-        sat_data = calculate_satellite_timeseries(tle, observer_pos, ts, start_time)
-        satellites_data.append(sat_data)
-
-        if sat_data['statistics']['visible_points'] > 0:
-            visible_satellites += 1
-            print(f"✓ ({sat_data['statistics']['visible_percentage']:.1f}% 可見)")
-        else:
-            print("⚠️  (不可見)")
+    # 依 CPU 數平均切分批次（每批一次 SGP4 呼叫，批次大小不超過 SGP4_BATCH_SIZE）
+    workers = os.cpu_count() or 1
+    batch_size = max(1, min(SGP4_BATCH_SIZE, -(-len(tle_satellites) // workers)))
+    tle_batches = [
+        tle_satellites[batch_start:batch_start + batch_size]
+        for batch_start in range(0, len(tle_satellites), batch_size)
+    ]
 
-    # 生成輸出 JSON
-    output_data = {
+    # 輸出 JSON 的檔頭（統計依賴逐顆計算結果，寫在衛星數據之後）
+    header = {
         'metadata': {
             'generated_at': datetime.now(timezone.utc).isoformat(),
             'generator': 'generate-satellite-timeseries.py',
             'description': 'NTPU 衛星可見性時間序列數據',
             'warning': '⚠️ 此數據基於 TLE epoch 時間計算，請勿使用當前時間進行實時計算',
+            'start_time': start_time.utc_iso(),
             'observer': {
                 'name': 'National Taipei University',
                 'latitude': OBSERVER_LAT,
                 'longitude': OBSERVER_LON,
                 'altitude': OBSERVER_ALT
             }
-        },
-        'statistics': {
-            'total_satellites': len(tle_satellites),
-            'processed_satellites': len(satellites_data),
-            'visible_satellites': visible_satellites
-        },
-        'satellites': satellites_data
+        }
     }
+    counters = {'processed': 0, 'visible': 0}
+
+    def footer():
+        return {
+            'statistics': {
+                'total_satellites': len(tle_satellites),
+                'processed_satellites': counters['processed'],
+                'visible_satellites': counters['visible']
+            }
+        }
 
-    # 保存到文件
-    print(f"\n💾 保存數據到: {OUTPUT_FILE}")
+    # 平行計算每批衛星，結果逐顆寫入暫存文件，全部完成後才替換輸出文件
+    print(f"\n🛰️  計算衛星位置（{workers} 個進程）...")
+    print(f"   💾 輸出文件: {OUTPUT_FILE}")
     OUTPUT_FILE.parent.mkdir(parents=True, exist_ok=True)
 
-    with open(OUTPUT_FILE, 'w', encoding='utf-8') as f:
-        json.dump(output_data, f, indent=2, ensure_ascii=False)
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=init_worker,
+        initargs=(_setup_worker, start_time.ut1)
+    ) as executor:
+        try:
+            batches = executor.map(_calculate_batch_worker, tle_batches)
+            progress = report_progress(
+                chain.from_iterable(batches), len(tle_satellites), counters, lambda sat: sat['name']
+            )
+            write_timeseries_json(OUTPUT_FILE, header, progress, footer)
+        except BaseException:
+            # 計算失敗或中斷時取消尚未開始的批次，立即結束（原輸出文件保持不變）
+            executor.shutdown(cancel_futures=True)
+            raise
 
     file_size = OUTPUT_FILE.stat().st_size / 1024  # KB
     print(f"   ✓ 保存成功 ({file_size:.1f} KB)")
@@ -220,7 +287,7 @@ def main():
     # 統計摘要
     print(f"\n📊 生成摘要:")
     print(f"   總衛星數: {len(tle_satellites)}")
-    print(f"   可見衛星: {visible_satellites}")
+    print(f"   可見衛星: {counters['visible']}")
     print(f"   數據點數: {len(tle_satellites) * ((DURATION_HOURS * 3600) // TIME_STEP_SECONDS)}")
 
     print("\n✅ 完成！")
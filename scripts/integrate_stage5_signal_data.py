@@ -10,29 +10,71 @@
 輸出：satellite-timeseries-{constellation}-enhanced.json
 """
 
-import json
+import io
+import os
+import numpy as np
+import orjson
 import argparse
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stdout
 from datetime import datetime
 from pathlib import Path
 from collections import defaultdict
 
+from _orbit_ts_core import parse_timestamps
+
 # 文件路徑
 PROJECT_ROOT = Path(__file__).parent.parent
 STAGE4_FILE = Path("/home/sat/satellite/orbit-engine/data/outputs/stage4/link_feasibility_output_20251103_060257.json")
 STAGE5_FILE = Path("/home/sat/satellite/orbit-engine/data/outputs/stage5/stage5_signal_analysis_elite_pool_20251125_133343.json")
 
+# 時間戳匹配容許誤差（±30 秒，單位微秒）
+MATCH_TOLERANCE_US = 30_000_000
+
+# 輸出的訊號品質欄位（每個欄位一個與樣本對齊的陣列，無匹配為 null）
+SIGNAL_FIELDS = ('rsrp_dbm', 'rsrq_db', 'rs_sinr_db')
+
+def to_unix_us(timestamps):
+    """將 ISO-8601 UTC 時間戳字串批次轉為 Unix 微秒（int64 陣列）"""
+    return parse_timestamps(timestamps).astype('datetime64[us]').astype(np.int64)
+
+def build_stage5_index(time_series):
+    """
+    構建單顆衛星的 Stage 5 時間索引
+
+    Returns:
+        {'timestamps_us': 依時間排序的 Unix 微秒陣列,
+         'signal_quality': {欄位: 對齊的 float 陣列（缺值為 NaN）}}
+    """
+    timestamps_us = to_unix_us([point['timestamp'] for point in time_series])
+    order = np.argsort(timestamps_us, kind='stable')
+    qualities = [time_series[i]['signal_quality'] for i in order.tolist()]
+    return {
+        'timestamps_us': timestamps_us[order],
+        'signal_quality': {
+            field: np.array([quality.get(field) for quality in qualities], dtype=np.float64)
+            for field in SIGNAL_FIELDS
+        }
+    }
+
 def load_stage5_signal_data(constellation='starlink'):
-    """載入 Stage 5 訊號品質數據"""
+    """
+    載入 Stage 5 訊號品質數據
+
+    時間戳在載入時就解析並排序（每個時間戳只解析一次）
+
+    Returns:
+        {sat_id: {'timestamps_us': 排序後的 Unix 微秒陣列, 'signal_quality': 對齊的各欄位陣列}}
+    """
     print(f"📂 載入 Stage 5 訊號品質數據（星座: {constellation.upper()}）...")
 
-    with open(STAGE5_FILE, 'r') as f:
-        data = json.load(f)
+    data = orjson.loads(STAGE5_FILE.read_bytes())
 
     # 按星座過濾
     signal_data = {}
     for sat_id, sat_data in data['signal_analysis'].items():
         if sat_data['constellation'].lower() == constellation.lower():
-            signal_data[sat_id] = sat_data
+            signal_data[sat_id] = build_stage5_index(sat_data['time_series'])
 
     print(f"   ✓ 找到 {len(signal_data)} 顆 {constellation.upper()} 衛星的訊號數據")
     return signal_data
@@ -42,55 +84,61 @@ def load_stage4_timeseries(constellation='starlink'):
     timeseries_file = PROJECT_ROOT / f"public/data/satellite-timeseries-{constellation}.json"
 
     print(f"📂 載入前端 timeseries 數據...")
-    with open(timeseries_file, 'r') as f:
-        data = json.load(f)
+    data = orjson.loads(timeseries_file.read_bytes())
 
     print(f"   ✓ 載入 {len(data['satellites'])} 顆衛星的時間序列")
     return data
 
-def match_timestamps(stage4_ts, stage5_ts):
+def match_signal_quality(stage4_us, stage5_us, stage5_quality):
     """
-    匹配兩個時間戳（允許小誤差）
+    以排序後的 Stage 5 時間軸為每個 Stage 4 時間點尋找最接近的訊號品質
 
-    Args:
-        stage4_ts: Stage 4 時間戳字符串
-        stage5_ts: Stage 5 時間戳字符串
+    只接受誤差在 MATCH_TOLERANCE_US 內的匹配（完全相同的時間戳誤差為 0，必定優先）。
 
     Returns:
-        bool: 是否匹配
+        ({欄位: 與 stage4_us 對齊的 float 陣列，無匹配的位置為 NaN}, 匹配成功的布林遮罩)
     """
-    from dateutil import parser
-
-    try:
-        t4 = parser.parse(stage4_ts)
-        t5 = parser.parse(stage5_ts)
-
-        # 允許 ±30 秒誤差
-        diff = abs((t4 - t5).total_seconds())
-        return diff <= 30
-    except:
-        return False
+    if len(stage5_us) == 0:
+        return (
+            {field: np.full(len(stage4_us), np.nan) for field in SIGNAL_FIELDS},
+            np.zeros(len(stage4_us), dtype=bool)
+        )
+
+    # 二分搜尋插入位置，比較左右兩個相鄰點取較近者
+    right = np.searchsorted(stage5_us, stage4_us).clip(max=len(stage5_us) - 1)
+    left = (right - 1).clip(min=0)
+    left_delta = np.abs(stage4_us - stage5_us[left])
+    right_delta = np.abs(stage4_us - stage5_us[right])
+
+    nearest = np.where(left_delta <= right_delta, left, right)
+    matched = np.minimum(left_delta, right_delta) <= MATCH_TOLERANCE_US
+
+    return (
+        {field: np.where(matched, values[nearest], np.nan) for field, values in stage5_quality.items()},
+        matched
+    )
 
 def integrate_signal_quality(timeseries_data, signal_data):
     """
     整合訊號品質數據到 timeseries
 
+    訊號品質以 SoA 格式存放：{'rsrp_dbm': [...], 'rsrq_db': [...], 'rs_sinr_db': [...]}，
+    無匹配的樣本為 null。支援兩種格式：
+    - position_timeseries：衛星層級的 satellite['signal_quality']，與 position_timeseries 逐點對齊
+    - visible_intervals（稀疏格式）：每個區段的 interval['signal_quality']，與區段樣本對齊
+
     Args:
         timeseries_data: 前端 timeseries 數據
-        signal_data: Stage 5 訊號數據
+        signal_data: Stage 5 訊號數據索引（load_stage5_signal_data 的輸出）
 
     Returns:
         更新後的 timeseries 數據
     """
     print("\n🔗 整合訊號品質數據...")
 
-    # 構建 Stage 5 時間戳索引
-    stage5_index = {}
-    for sat_id, sat_data in signal_data.items():
-        stage5_index[sat_id] = {}
-        for point in sat_data['time_series']:
-            ts = point['timestamp']
-            stage5_index[sat_id][ts] = point
+    # 時間軸：新格式統一存放於 time_axis（整個檔案只解析一次），舊格式每個數據點自帶 time
+    time_axis = timeseries_data.get('time_axis')
+    time_axis_us = to_unix_us(time_axis) if time_axis else None
 
     matched_count = 0
     total_points = 0
@@ -100,49 +148,40 @@ def integrate_signal_quality(timeseries_data, signal_data):
         sat_id = satellite['id']
 
         # 檢查是否有對應的 Stage 5 數據
-        if sat_id not in stage5_index:
+        if sat_id not in signal_data:
             print(f"   ⚠️  衛星 {sat_id} 沒有 Stage 5 數據，跳過")
             continue
 
-        # 遍歷時間點
-        for point in satellite['position_timeseries']:
-            total_points += 1
-
-            # 如果不可見，設置默認值
-            if not point['is_visible']:
-                point['signal_quality'] = {
-                    'rsrp_dbm': None,
-                    'rsrq_db': None,
-                    'rs_sinr_db': None
-                }
-                continue
-
-            # 嘗試匹配時間戳
-            stage4_ts = point['time']
-            matched = False
-
-            # 精確匹配
-            if stage4_ts in stage5_index[sat_id]:
-                signal_point = stage5_index[sat_id][stage4_ts]
-                point['signal_quality'] = signal_point['signal_quality']
-                matched_count += 1
-                matched = True
-            else:
-                # 模糊匹配（允許 ±30 秒）
-                for stage5_ts, signal_point in stage5_index[sat_id].items():
-                    if match_timestamps(stage4_ts, stage5_ts):
-                        point['signal_quality'] = signal_point['signal_quality']
-                        matched_count += 1
-                        matched = True
-                        break
-
-            if not matched:
-                # 沒有匹配，設置為 None
-                point['signal_quality'] = {
-                    'rsrp_dbm': None,
-                    'rsrq_db': None,
-                    'rs_sinr_db': None
-                }
+        stage5_us = signal_data[sat_id]['timestamps_us']
+        stage5_quality = signal_data[sat_id]['signal_quality']
+
+        # 稀疏格式：只有可見區段需要匹配，不可見時段由前端補默認值
+        if 'visible_intervals' in satellite:
+            total_points += satellite['config']['time_points']
+            for interval in satellite['visible_intervals']:
+                interval['signal_quality'], matched = match_signal_quality(
+                    time_axis_us[interval['start_idx']:interval['end_idx'] + 1], stage5_us, stage5_quality
+                )
+                matched_count += int(matched.sum())
+            continue
+
+        points = satellite['position_timeseries']
+        total_points += len(points)
+
+        # 只匹配可見時間點，不可見或沒有匹配的時間點為 null
+        visible_idx = np.array([point['is_visible'] for point in points], dtype=bool).nonzero()[0]
+        if time_axis_us is not None:
+            stage4_us = time_axis_us[visible_idx]
+        else:
+            stage4_us = to_unix_us([points[time_idx]['time'] for time_idx in visible_idx.tolist()])
+
+        visible_quality, matched = match_signal_quality(stage4_us, stage5_us, stage5_quality)
+        signal_quality = {field: np.full(len(points), np.nan) for field in SIGNAL_FIELDS}
+        for field, values in visible_quality.items():
+            signal_quality[field][visible_idx] = values
+
+        satellite['signal_quality'] = signal_quality
+        matched_count += int(matched.sum())
 
     match_rate = (matched_count / total_points * 100) if total_points > 0 else 0
     print(f"   ✓ 匹配成功: {matched_count}/{total_points} 時間點 ({match_rate:.1f}%)")
@@ -161,14 +200,45 @@ def save_enhanced_timeseries(data, constellation):
 
     print(f"\n💾 保存增強數據到: {output_file}")
 
-    with open(output_file, 'w', encoding='utf-8') as f:
-        json.dump(data, f, indent=2, ensure_ascii=False)
+    output_file.write_bytes(orjson.dumps(data, option=orjson.OPT_INDENT_2 | orjson.OPT_SERIALIZE_NUMPY))
 
     file_size = output_file.stat().st_size / 1024 / 1024  # MB
     print(f"   ✓ 保存成功 ({file_size:.2f} MB)")
 
     return output_file
 
+def process_constellation(constellation):
+    """整合單一星座：載入 Stage 5 / Stage 4 數據、匹配訊號品質並保存"""
+    print("=" * 60)
+    print(f"📡 整合 {constellation.upper()} 訊號品質數據")
+    print("=" * 60)
+
+    # 1. 載入 Stage 5 訊號數據
+    signal_data = load_stage5_signal_data(constellation)
+
+    # 2. 載入前端 timeseries 數據
+    timeseries_data = load_stage4_timeseries(constellation)
+
+    # 3. 整合訊號品質
+    enhanced_data = integrate_signal_quality(timeseries_data, signal_data)
+
+    # 4. 保存增強數據
+    output_file = save_enhanced_timeseries(enhanced_data, constellation)
+
+    print(f"\n✅ {constellation.upper()} 數據整合完成！")
+    print(f"   輸出文件: {output_file}")
+    print("=" * 60)
+    print()
+
+    return output_file
+
+def _process_constellation_buffered(constellation):
+    """子進程工作函數：整合單一星座，輸出訊息先緩存，完成後整段交回主進程輸出（避免多個星座的訊息交錯）"""
+    buffer = io.StringIO()
+    with redirect_stdout(buffer):
+        process_constellation(constellation)
+    return buffer.getvalue()
+
 def main():
     parser = argparse.ArgumentParser(
         description='整合 orbit-engine Stage 5 訊號品質數據',
@@ -200,28 +270,15 @@ def main():
     else:
         constellations = [args.constellation]
 
-    # 處理每個星座
-    for constellation in constellations:
-        print("=" * 60)
-        print(f"📡 整合 {constellation.upper()} 訊號品質數據")
-        print("=" * 60)
-
-        # 1. 載入 Stage 5 訊號數據
-        signal_data = load_stage5_signal_data(constellation)
-
-        # 2. 載入前端 timeseries 數據
-        timeseries_data = load_stage4_timeseries(constellation)
-
-        # 3. 整合訊號品質
-        enhanced_data = integrate_signal_quality(timeseries_data, signal_data)
-
-        # 4. 保存增強數據
-        output_file = save_enhanced_timeseries(enhanced_data, constellation)
+    if len(constellations) == 1:
+        process_constellation(constellations[0])
+        return
 
-        print(f"\n✅ {constellation.upper()} 數據整合完成！")
-        print(f"   輸出文件: {output_file}")
-        print("=" * 60)
-        print()
+    # 各星座互相獨立，以多進程並行處理；每個子進程各自載入完整的 Stage 5 文件，
+    # 峰值記憶體約為逐一處理時的星座數倍
+    with ProcessPoolExecutor(max_workers=min(len(constellations), os.cpu_count() or 1)) as executor:
+        for log in executor.map(_process_constellation_buffered, constellations):
+            print(log, end='')
 
 if __name__ == '__main__':
     main()
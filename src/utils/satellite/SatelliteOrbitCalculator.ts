@@ -20,7 +20,7 @@ import { Vector3 } from 'three';
  * 單個時間序列數據點
  */
 export interface TimeseriesPoint {
-  time: string;                    // ISO 時間格式
+  time?: string;                   // ISO 時間格式（新格式改由檔案層級 time_axis 提供）
   time_offset_seconds: number;     // 相對於起始時間的偏移（秒）
   elevation_deg: number;           // 仰角（度）
   azimuth_deg: number;            // 方位角（度）
@@ -28,6 +28,36 @@ export interface TimeseriesPoint {
   is_visible: boolean;            // 是否可見（仰角 >= min_elevation）
 }
 
+/**
+ * 可見區段（稀疏格式：只記錄連續可見的時間點）
+ */
+export interface VisibleInterval {
+  start_idx: number;               // 開始索引（對應 time_axis）
+  end_idx: number;                 // 結束索引（含）
+  elevation_deg: number[];         // 區段內各點仰角（量化整數，× scale.elevation_deg 為度）
+  azimuth_deg: number[];           // 區段內各點方位角（量化整數，× scale.azimuth_deg 為度）
+  range_km: number[];              // 區段內各點距離（量化整數，× scale.range_km 為公里）
+}
+
+/**
+ * 平行陣列（SoA 格式）：第 i 個元素對應時間偏移 i * time_step_seconds
+ */
+export interface PositionArrays {
+  elevation_deg: number[];         // 仰角（度）
+  azimuth_deg: number[];           // 方位角（度）
+  range_km: number[];              // 距離（公里）
+  is_visible: boolean[];           // 是否可見
+}
+
+/**
+ * 量化比例（實際值 = 整數 × 比例），未提供的欄位視為 1
+ */
+export interface ValueScale {
+  elevation_deg?: number;
+  azimuth_deg?: number;
+  range_km?: number;
+}
+
 /**
  * 衛星完整數據
  */
@@ -53,6 +83,8 @@ export interface SatelliteData {
     max_elevation: number;
   };
   position_timeseries: TimeseriesPoint[];
+  visible_intervals?: VisibleInterval[];  // 稀疏格式，載入時展開為 position_timeseries
+  position_arrays?: PositionArrays;       // SoA 格式，載入時展開為 position_timeseries
 }
 
 /**
@@ -64,12 +96,15 @@ export interface TimeseriesDataFile {
     generator: string;
     description: string;
     warning: string;
+    scale?: ValueScale;            // visible_intervals 數值的量化比例
+    start_time?: string;           // 起始時間（ISO 格式，position_arrays 索引 0 對應此時間）
   };
   statistics: {
     total_satellites: number;
     processed_satellites: number;
     visible_satellites: number;
   };
+  time_axis?: string[];           // 共用時間軸（ISO 格式），索引對應 position_timeseries / visible_intervals
   satellites: SatelliteData[];
 }
 
@@ -118,6 +153,18 @@ export class SatelliteOrbitCalculator {
 
       // 載入每顆衛星
       data.satellites.forEach((sat) => {
+        // 稀疏格式：展開為完整時間序列（不可見時段補默認值）
+        if (!sat.position_timeseries && sat.visible_intervals) {
+          sat.position_timeseries = this.expandVisibleIntervals(
+            sat.visible_intervals,
+            sat.config,
+            data.metadata?.scale ?? {}
+          );
+        } else if (!sat.position_timeseries && sat.position_arrays) {
+          // SoA 格式：平行陣列轉為逐點格式
+          sat.position_timeseries = this.expandPositionArrays(sat.position_arrays, sat.config.time_step_seconds);
+        }
+
         this.satelliteData.set(sat.id, sat);
 
         // 提取可見窗口
@@ -134,6 +181,58 @@ export class SatelliteOrbitCalculator {
     }
   }
 
+  /**
+   * 將稀疏的可見區段展開為完整時間序列
+   *
+   * 不可見時間點使用默認值：仰角 -90°、方位角 0°、距離 9999 km；
+   * 區段內的量化整數乘上對應比例還原為實際值
+   */
+  private expandVisibleIntervals(
+    intervals: VisibleInterval[],
+    config: SatelliteData['config'],
+    scale: ValueScale
+  ): TimeseriesPoint[] {
+    const timeseries: TimeseriesPoint[] = [];
+    const elevationScale = scale.elevation_deg ?? 1;
+    const azimuthScale = scale.azimuth_deg ?? 1;
+    const rangeScale = scale.range_km ?? 1;
+
+    for (let index = 0; index < config.time_points; index++) {
+      timeseries.push({
+        time_offset_seconds: index * config.time_step_seconds,
+        elevation_deg: -90,
+        azimuth_deg: 0,
+        range_km: 9999,
+        is_visible: false,
+      });
+    }
+
+    intervals.forEach((interval) => {
+      for (let k = 0; k <= interval.end_idx - interval.start_idx; k++) {
+        const point = timeseries[interval.start_idx + k];
+        point.elevation_deg = interval.elevation_deg[k] * elevationScale;
+        point.azimuth_deg = interval.azimuth_deg[k] * azimuthScale;
+        point.range_km = interval.range_km[k] * rangeScale;
+        point.is_visible = true;
+      }
+    });
+
+    return timeseries;
+  }
+
+  /**
+   * 將平行陣列（SoA）轉為逐點的時間序列
+   */
+  private expandPositionArrays(arrays: PositionArrays, timeStep: number): TimeseriesPoint[] {
+    return arrays.elevation_deg.map((elevation, index) => ({
+      time_offset_seconds: index * timeStep,
+      elevation_deg: elevation,
+      azimuth_deg: arrays.azimuth_deg[index],
+      range_km: arrays.range_km[index],
+      is_visible: arrays.is_visible[index],
+    }));
+  }
+
   /**
    * 提取可見窗口
    *